@@ -0,0 +1,74 @@
+"""
+Measures server startup time and first-request latency, with and without warm start.
+
+  $ python3 benchmark.py --repo-url https://github.com/<owner>/<repo>
+
+For each mode a fresh server is started with uvicorn. Startup is the time until
+`/` responds. The first requests are then sent right away, while warm start may
+still be running in the background: loading the repo (which is what a client
+has to do first after a restart) and a search in it. Load the repo once before
+benchmarking so it is indexed and in the recent repos that warm start preloads.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import requests
+
+
+def free_port():
+  with socket.socket() as sock:
+    sock.bind(("127.0.0.1", 0))
+    return sock.getsockname()[1]
+
+
+def timed_get(url, **params):
+  start = time.perf_counter()
+  response = requests.get(url, params=params)
+  response.raise_for_status()
+  return time.perf_counter() - start
+
+
+def run_server(warm_start, repo_url, query, timeout=60):
+  port = free_port()
+  base_url = f"http://127.0.0.1:{port}"
+  env = dict(os.environ, WARM_START="1" if warm_start else "0")
+  start = time.perf_counter()
+  server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    while True:
+      try:
+        requests.get(f"{base_url}/")
+        break
+      except requests.ConnectionError:
+        if server.poll() is not None or time.perf_counter() - start > timeout:
+          raise RuntimeError("Server did not start")
+        time.sleep(0.01)
+    result = {"startup": time.perf_counter() - start}
+    if repo_url:
+      result["load repo"] = timed_get(f"{base_url}/select_and_load_repo", repo_url=repo_url)
+      result["search"] = timed_get(f"{base_url}/search_file_metadata_in_repo", query_keywords=query)
+    return result
+  finally:
+    server.terminate()
+    server.wait()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--repo-url", help="url of an already loaded repo to time the first requests against")
+  parser.add_argument("--query", default="main")
+  args = parser.parse_args()
+
+  for warm_start in (False, True):
+    label = "warm start" if warm_start else "cold start"
+    for step, seconds in run_server(warm_start, args.repo_url, args.query).items():
+      print(f"{label} {step}: {seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+  main()
@@ -1,19 +1,34 @@
 import json
 import os
 import requests
+import threading
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 
-from shoggoth_coder.repo_utils import repo_name_from_url, commit_and_push_pr, clear_repo_changes, fork_and_clone_repo
-from shoggoth_coder.repo_embedder.embedder import create_repo_embedding, search_repo_embeddings
+from shoggoth_coder.repo_utils import (DEFAULT_SESSION, repo_name_from_url, commit_and_push_pr, clear_repo_changes,
+                                       fork_and_clone_repo, remove_worktree, session_dir, worktree_path,
+                                       recent_repos, record_recent_repo)
+from shoggoth_coder.repo_embedder.embedder import create_repo_embedding, search_repo_embeddings, warm_start
 
 from dotenv import load_dotenv
 load_dotenv()
 
-app = FastAPI()
+# Set WARM_START=1 to preload indexes of recent repos while serving requests
+WARM_START = os.environ.get("WARM_START", "").lower() in ("1", "true", "yes")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  if WARM_START:
+    threading.Thread(target=warm_start, args=(recent_repos(),), daemon=True).start()
+  yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -24,12 +39,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-active_repo = ""
-active_repo_url = ""
-
 
 class RepoContext:
-  pass
+  def __init__(self, repo_name="", repo_url=""):
+    self.repo_name = repo_name
+    self.repo_url = repo_url
+
+
+# session id -> RepoContext of the repo active in that session
+active_repos = {}
+
+
+def get_active_repo(session_id):
+  if session_id not in active_repos:
+    raise HTTPException(
+      status_code=404,
+      detail="No repo has been loaded yet. Try selecting a repo first.")
+  return active_repos[session_id]
+
+
+def path_in_session(file_path, session_id):
+  try:
+    return os.path.join(session_dir(session_id), file_path)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
 
 
 class StagingArea:
@@ -52,18 +85,20 @@ async def search_github_repo(query: str):
 
 
 @app.get("/select_and_load_repo")
-async def select_and_load_repo(repo_url: str):
+async def select_and_load_repo(repo_url: str, session_id: str = DEFAULT_SESSION):
   print("We got the repo url", repo_url)
-  clone_success = fork_and_clone_repo(repo_url)
+  try:
+    clone_success = fork_and_clone_repo(repo_url, session_id)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
   if clone_success:
-    global active_repo
-    global active_repo_url
-    active_repo = repo_name_from_url(repo_url)
-    active_repo_url = repo_url
-    print("Set active repo to: ", active_repo)
+    active_repos[session_id] = RepoContext(repo_name_from_url(repo_url), repo_url)
+    record_recent_repo(active_repos[session_id].repo_name)
+    print(f"Set active repo of session {session_id} to: ", active_repos[session_id].repo_name)
 
+  active_repo = get_active_repo(session_id).repo_name
   print(f"Generate relevant embeddings for repo: {active_repo}")
-  create_repo_embedding(active_repo, f".cache/repo/{active_repo}")
+  create_repo_embedding(active_repo, worktree_path(active_repo, session_id))
   metadata = search_repo_embeddings("main", active_repo)
   return {
     "message": "This repo has been succesfully loaded and is now active",
@@ -71,26 +106,19 @@ async def select_and_load_repo(repo_url: str):
   }
 
 @app.get("/search_file_metadata_in_repo")
-async def search_file_metadata_in_repo(query_keywords: str):
+async def search_file_metadata_in_repo(query_keywords: str, session_id: str = DEFAULT_SESSION):
   """
   Does an embeddings search on repo based on query keywords to retrieve top_k relevant files metadata
   """
-  if active_repo == "":
-    raise HTTPException(
-      status_code=404,
-      detail="No repo has been loaded yet. Try selecting a repo first.")
-  
+  active_repo = get_active_repo(session_id).repo_name
   metadata = search_repo_embeddings(query_keywords, active_repo)
   return {"results": metadata}
 
 
 @app.get("/load_contents_from_repo_file")
-async def load_contents_from_repo_file(file_path: str):
-  if active_repo == "":
-    raise HTTPException(
-      status_code=404,
-      detail="No repo has been loaded yet. Try selecting a repo first.")
-  path_in_repo_cache = f".cache/repo/{file_path}"
+async def load_contents_from_repo_file(file_path: str, session_id: str = DEFAULT_SESSION):
+  get_active_repo(session_id)
+  path_in_repo_cache = path_in_session(file_path, session_id)
   if not os.path.exists(path_in_repo_cache):
     raise HTTPException(
       status_code=404,
@@ -103,17 +131,15 @@ async def load_contents_from_repo_file(file_path: str):
 
 
 @app.post("/update_contents_in_repo_file")
-async def update_contents_in_repo_file(file_path: str, updated_code: str):
+async def update_contents_in_repo_file(file_path: str, updated_code: str,
+                                       session_id: str = DEFAULT_SESSION):
   """
   Update the contents of file with new code.
   """
   print("path", file_path)
   print("updated_code", updated_code)
-  if active_repo == "":
-    raise HTTPException(
-      status_code=404,
-      detail="No repo has been loaded yet. Try selecting a repo first.")
-  path_in_repo_cache = f".cache/repo/{file_path}"
+  get_active_repo(session_id)
+  path_in_repo_cache = path_in_session(file_path, session_id)
   if not os.path.exists(path_in_repo_cache):
     raise HTTPException(
       status_code=404,
@@ -128,16 +154,16 @@ async def update_contents_in_repo_file(file_path: str, updated_code: str):
 
 @app.post("/commit_changes_and_create_pr")
 async def commit_changes_and_create_pr(commit_message: str, pr_title: str,
-                                       pr_description: str):
+                                       pr_description: str, session_id: str = DEFAULT_SESSION):
   """
   Commit the changes to the git repo, and create and submit a pull request.
   """
-  if active_repo == "":
-    raise HTTPException(
-      status_code=404,
-      detail="No repo has been loaded yet. Try selecting a repo first.")
-  pr_url = commit_and_push_pr(active_repo_url, active_repo, commit_message, pr_title,
-                              pr_description)
+  repo_context = get_active_repo(session_id)
+  try:
+    pr_url = commit_and_push_pr(repo_context.repo_url, repo_context.repo_name, commit_message, pr_title,
+                                pr_description, session_id)
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
   return {
     "message": "Pull request has been successfully created.",
     "pull_request_url": pr_url
@@ -145,17 +171,32 @@ async def commit_changes_and_create_pr(commit_message: str, pr_title: str,
 
 
 @app.post("/reset_all_repo_changes")
-async def reset_all_repo_changes():
+async def reset_all_repo_changes(session_id: str = DEFAULT_SESSION):
   """
   Resets all changes made to the active repo
   """
-  clear_repo_changes(active_repo)
+  active_repo = get_active_repo(session_id).repo_name
+  clear_repo_changes(active_repo, session_id)
   return {
     "message": "Successfully cleared the active repo.",
     "active_repo": active_repo
   }
 
 
+@app.post("/close_repo_session")
+async def close_repo_session(session_id: str = DEFAULT_SESSION):
+  """
+  Removes the session's checkout of the active repo, discarding its changes
+  """
+  active_repo = get_active_repo(session_id).repo_name
+  remove_worktree(active_repo, session_id)
+  del active_repos[session_id]
+  return {
+    "message": "Successfully closed the repo session.",
+    "active_repo": active_repo
+  }
+
+
 @app.get("/")
 async def hello_world():
   return ""
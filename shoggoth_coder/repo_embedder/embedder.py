@@ -1,51 +1,145 @@
-import chromadb
-import openai
 import os
-import tiktoken
+import threading
 
-from chromadb.config import Settings
+from functools import lru_cache
 from pathlib import Path
-from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_not_exception_type
+from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception
+from shoggoth_coder.repo_embedder.embedding_cache import get_embedding_cache
 from shoggoth_coder.repo_embedder.metadata_extractors.extractor import get_metadata_extractor, metadata_to_amalgamation
 
+# chromadb, openai and tiktoken are slow to import, so they are only loaded on first use
+
 OPENAI_KEY = os.environ.get('OPENAI_API_KEY')
 
-# Set up OpenAI API
-openai.api_key = OPENAI_KEY
+_chroma_clients = {}
+_chroma_clients_lock = threading.Lock()
 
 EMBEDDING_MODEL = 'text-embedding-ada-002'
 EMBEDDING_CTX_LENGTH = 8191
 EMBEDDING_ENCODING = 'cl100k_base'
 
+# files are indexed in chunks of CHUNK_SIZE, and each file of a chunk gets an
+# equal share of the context so a chunk never sends more than EMBEDDING_CTX_LENGTH tokens
+CHUNK_SIZE = 5
+FILE_CTX_LENGTH = EMBEDDING_CTX_LENGTH // CHUNK_SIZE
+# embeddings are cached per model and token budget, as both change the vector
+EMBEDDING_CACHE_MODEL = f"{EMBEDDING_MODEL}:{FILE_CTX_LENGTH}"
+
 SUPPORTED_LANGUAGES = ['py', 'js']
 
+# bump when the way files are chunked or embedded changes, existing collections
+# are rebuilt on the next load since their ids and vectors no longer match
+CHUNKING_VERSION = 2
+
+@lru_cache(maxsize=None)
+def get_openai():
+    """Import and configure the OpenAI API on first use."""
+    import openai
+    openai.api_key = OPENAI_KEY
+    return openai
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name=EMBEDDING_ENCODING):
+    """Load the tiktoken encoding once, it takes a while to build."""
+    import tiktoken
+    return tiktoken.get_encoding(encoding_name)
+
+
+def get_chroma_client(repo_name):
+    """Open (once) the persisted ChromaDB client of a repo."""
+    # locked since warm start opens clients from a background thread
+    with _chroma_clients_lock:
+        if repo_name not in _chroma_clients:
+            import chromadb
+            from chromadb.config import Settings
+            repo_embedding_cache_dir = f"./.cache/chroma-embeddings-{repo_name}"
+            _chroma_clients[repo_name] = chromadb.Client(Settings(chroma_db_impl="duckdb+parquet",
+            persist_directory=repo_embedding_cache_dir))
+        return _chroma_clients[repo_name]
+
+
 def truncate_text_tokens(text, encoding_name=EMBEDDING_ENCODING, max_tokens=EMBEDDING_CTX_LENGTH):
     """Truncate a string to have `max_tokens` according to the given encoding."""
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding(encoding_name)
     return encoding.encode(text)[:max_tokens]
 
-@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6), retry=retry_if_not_exception_type(openai.InvalidRequestError))
+def _should_retry(exception):
+    return not isinstance(exception, get_openai().InvalidRequestError)
+
+@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6), retry=retry_if_exception(_should_retry))
 def generate_embeddings(text_or_tokens, model=EMBEDDING_MODEL):
-    return openai.Embedding.create(input=text_or_tokens, model=model)["data"][0]["embedding"]
+    return get_openai().Embedding.create(input=text_or_tokens, model=model)["data"][0]["embedding"]
+
+@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6), retry=retry_if_exception(_should_retry))
+def generate_batch_embeddings(texts_or_tokens, model=EMBEDDING_MODEL):
+    data = get_openai().Embedding.create(input=texts_or_tokens, model=model)["data"]
+    return [item["embedding"] for item in sorted(data, key=lambda item: item["index"])]
+
+
+def combine_embeddings(embeddings):
+    """Average embeddings and scale the result back to unit length."""
+    combined = [sum(values) / len(embeddings) for values in zip(*embeddings)]
+    norm = sum(value * value for value in combined) ** 0.5
+    return [value / norm for value in combined] if norm else combined
+
+
+def embed_files_with_cache(codes, embedding_cache):
+    """
+    Embed each file on its own, keyed by its content in the embedding cache, so a
+    file is only sent to the API if it was never embedded before in any repo.
+    """
+    embeddings = embedding_cache.get_many(codes, EMBEDDING_CACHE_MODEL)
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        generated = generate_batch_embeddings(
+            [truncate_text_tokens(codes[i], max_tokens=FILE_CTX_LENGTH) for i in missing])
+        embedding_cache.put_many([codes[i] for i in missing], EMBEDDING_CACHE_MODEL, generated)
+        for i, embedding in zip(missing, generated):
+            embeddings[i] = embedding
+    return embeddings
+
+
+def get_repo_collection(chroma_client, repo_name):
+    """Get the repo collection, rebuilding it if it was built with older chunking."""
+    collection = chroma_client.get_or_create_collection(name=repo_name)
+    if (collection.metadata or {}).get("chunking_version") != CHUNKING_VERSION:
+        if collection.count() != 0:
+            print(f"Rebuilding index of {repo_name} as it was built with older chunking")
+        chroma_client.delete_collection(name=repo_name)
+        collection = chroma_client.create_collection(name=repo_name, metadata={"chunking_version": CHUNKING_VERSION})
+    return collection
+
+
+def warm_start(repo_names):
+    """
+    Preload the tokenizer, the OpenAI module and the indexes of the given repos
+    so the first search doesn't pay for it.
+    """
+    get_encoding()
+    get_openai()
+    for repo_name in repo_names:
+        if not os.path.exists(f"./.cache/chroma-embeddings-{repo_name}"):
+            continue
+        collection = get_chroma_client(repo_name).get_or_create_collection(name=repo_name)
+        print(f"Warmed up index of {repo_name} ({collection.count()} entries)")
 
 
 def create_repo_embedding(repo_name, repo_path):
-    # setup chroma dir
-    repo_embedding_cache_dir = f"./.cache/chroma-embeddings-{repo_name}" 
-
     # Set up ChromaDB client and collection
-    chroma_client = chromadb.Client(Settings(chroma_db_impl="duckdb+parquet",
-    persist_directory=repo_embedding_cache_dir))
-    collection = chroma_client.get_or_create_collection(name=repo_name)
+    chroma_client = get_chroma_client(repo_name)
+    collection = get_repo_collection(chroma_client, repo_name)
 
     indexed_data = []
 
-    all_files = Path(repo_path).rglob("*")
+    # sorted so chunk ids are stable between loads
+    all_files = sorted(Path(repo_path).rglob("*"))
     for file in all_files:
         file_path = str(file)
         file_ext = os.path.splitext(file_path)[1][1:]
         file_name = file_path.split(os.sep)[-1]
-        file_path_key = os.sep.join(file_path.split(os.sep)[2:])
+        # key is relative to the dir holding the checkout, i.e. `{repo_name}/...`
+        file_path_key = os.path.relpath(file_path, os.path.dirname(os.path.normpath(repo_path)))
 
         try:
             metadata_extractor = get_metadata_extractor(file_ext)
@@ -64,9 +158,12 @@ def create_repo_embedding(repo_name, repo_path):
 
         indexed_data.append((None, code, file_name, metadata_str, file_path_key))
 
+    embedding_cache = get_embedding_cache()
+    hits_before, misses_before = embedding_cache.hits, embedding_cache.misses
+
     chunked_indexes = []
-    for i in range(0, len(indexed_data), 5):
-        chunked_indexes.append(indexed_data[i:i+5])
+    for i in range(0, len(indexed_data), CHUNK_SIZE):
+        chunked_indexes.append(indexed_data[i:i+CHUNK_SIZE])
 
     for chunk in chunked_indexes:
         combined_code = '\n\n'.join([code for _, code, _, _, _ in chunk])
@@ -80,9 +177,9 @@ def create_repo_embedding(repo_name, repo_path):
 
 
         print(f"Generation embedding for combined files {combined_file_name}")
-        # Generate embeddings for the code
-        truncated_code = truncate_text_tokens(combined_code)
-        embeddings = generate_embeddings(truncated_code)
+        # Embed each file (reusing cached ones) and combine them into the chunk embedding
+        file_embeddings = embed_files_with_cache([code for _, code, _, _, _ in chunk], embedding_cache)
+        embeddings = combine_embeddings(file_embeddings)
         # print(embeddings)
         # print(f"The combined metadata is {combined_metadata_amal}")
 
@@ -93,13 +190,12 @@ def create_repo_embedding(repo_name, repo_path):
             ids=[combined_file_name]
         )
     chroma_client.persist()
+    print(f"Embedding cache: {embedding_cache.hits - hits_before} hits, {embedding_cache.misses - misses_before} misses")
 
 
 def search_repo_embeddings(query, repo_name):
     # Set up ChromaDB client and collection
-    repo_embedding_cache_dir = f"./.cache/chroma-embeddings-{repo_name}" 
-    chroma_client = chromadb.Client(Settings(chroma_db_impl="duckdb+parquet",
-    persist_directory=repo_embedding_cache_dir))
+    chroma_client = get_chroma_client(repo_name)
     collection = chroma_client.get_or_create_collection(name=repo_name)
 
     # Generate embeddings for the code
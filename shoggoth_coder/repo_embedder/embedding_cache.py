@@ -0,0 +1,84 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from array import array
+
+EMBEDDING_CACHE_PATH = "./.cache/embedding-cache.sqlite"
+# an ada-002 embedding takes ~12KB, so the default bounds the cache to ~250MB
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES') or 20000)
+if EMBEDDING_CACHE_MAX_ENTRIES < 1:
+    raise ValueError(f"EMBEDDING_CACHE_MAX_ENTRIES must be at least 1, got {EMBEDDING_CACHE_MAX_ENTRIES}")
+
+
+def content_key(text, model):
+    """Hash of the file content and the model that embeds it."""
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of per-file embeddings shared by all repo collections,
+    so identical files (forks, branches, vendored copies) are only embedded once.
+    Entries are evicted least recently used first once `max_entries` is exceeded.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS embeddings (
+            key TEXT PRIMARY KEY,
+            embedding BLOB NOT NULL,
+            last_used REAL NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    def get_many(self, texts, model):
+        """Cached embeddings of the texts, None for the ones not in the cache."""
+        keys = [content_key(text, model) for text in texts]
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({', '.join('?' * len(keys))})", keys).fetchall()
+            found = {key: array("d", embedding).tolist() for key, embedding in rows}
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+        return [found.get(key) for key in keys]
+
+    def put_many(self, texts, model, embeddings):
+        now = time.time()
+        rows = [(content_key(text, model), array("d", embedding).tobytes(), now)
+                for text, embedding in zip(texts, embeddings)]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)", rows)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute("""DELETE FROM embeddings WHERE key IN (
+                SELECT key FROM embeddings ORDER BY last_used LIMIT ?)""", (count - self.max_entries,))
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """Open (once) the global embedding cache."""
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache()
+        return _embedding_cache
@@ -1,4 +1,8 @@
+import json
 import os
+import re
+import shutil
+import time
 import git
 from github import Github
 from dotenv import load_dotenv
@@ -8,6 +12,14 @@ gh_username = os.environ.get('gh_username', "<your-username>")
 gh_access_token = os.environ.get('gh_access_token', None)
 
 CACHE_DIR = ".cache/repo/"
+OBJECT_STORE_DIR = ".cache/objects/"
+WORKTREE_DIR = ".cache/worktrees/"
+
+DEFAULT_SESSION = "default"
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+RECENT_REPOS_FILE = ".cache/recent_repos.json"
+MAX_RECENT_REPOS = 5
 
 def https_to_ssh(https_url: str) -> str:
     parts = https_url.split('/')
@@ -24,13 +36,139 @@ def repo_name_from_url(repo_url):
   return repo_name
 
 
-def fork_and_clone_repo(repo_url):
-  if not os.path.exists(CACHE_DIR):
-    os.makedirs(CACHE_DIR)
+def session_dir(session_id=DEFAULT_SESSION):
+  """
+  Directory holding the worktree checkouts of a session. The default session
+  keeps using CACHE_DIR so existing `{repo_name}/...` paths stay valid.
+  """
+  if not SESSION_ID_PATTERN.fullmatch(session_id):
+    raise ValueError(f"Invalid session id: {session_id}")
+  if session_id == DEFAULT_SESSION:
+    return CACHE_DIR
+  return f"{WORKTREE_DIR}{session_id}/"
 
-  repo_name = repo_url.split("/")[-1].replace(".git", "")
-  repo_path = os.path.join(CACHE_DIR, repo_name)
 
+def worktree_path(repo_name, session_id=DEFAULT_SESSION):
+  return f"{session_dir(session_id)}{repo_name}"
+
+
+def session_branch(session_id=DEFAULT_SESSION):
+  return f"shoggoth-{session_id}"
+
+
+def default_branch(store):
+  # HEAD of the bare store points at the default branch of the remote
+  return store.git.symbolic_ref("--short", "HEAD")
+
+
+def _ensure_object_store(repo_name, clone_url, seed_path=None):
+  """
+  Clone (once) a bare object store for the repo that all worktrees share, or
+  fetch into it if it already exists. A local clone given as `seed_path` is
+  cloned from instead of the remote to save the network clone.
+  """
+  store_path = f"{OBJECT_STORE_DIR}{repo_name}.git"
+  if not os.path.exists(store_path):
+    os.makedirs(OBJECT_STORE_DIR, exist_ok=True)
+    if seed_path:
+      store = git.Repo.clone_from(seed_path, store_path, bare=True)
+      store.remotes.origin.set_url(clone_url)
+    else:
+      store = git.Repo.clone_from(clone_url, store_path, bare=True)
+    # bare clones don't track the remote, so set up origin/* refs for worktrees
+    store.git.config("remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*")
+  else:
+    store = git.Repo(store_path)
+  store.remotes.origin.fetch(prune=True)
+  return store
+
+
+def is_worktree(path):
+  # linked worktrees have a `.git` file pointing at the store, plain clones a `.git` dir
+  return os.path.isfile(os.path.join(path, ".git"))
+
+
+def has_local_work(repo):
+  # uncommitted changes, or commits on local branches that no remote branch has
+  return repo.is_dirty(untracked_files=True) or bool(repo.git.rev_list("--branches", "--not", "--remotes"))
+
+
+def _retire_standalone_clone(path):
+  """
+  Get a plain clone from before the shared object store out of the way of the
+  worktree. Clones with local work are moved aside instead of deleted.
+  """
+  if has_local_work(git.Repo(path)):
+    moved_path = f"{path}.pre-worktree-{int(time.time())}"
+    os.rename(path, moved_path)
+    print(f"Moved standalone clone with unpushed work from {path} to {moved_path}")
+  else:
+    shutil.rmtree(path)
+    print(f"Replaced standalone clone at {path} with a worktree")
+
+
+def checkout_worktree(repo_name, clone_url, session_id=DEFAULT_SESSION):
+  """
+  Make sure the session has a worktree of the repo, creating it on demand from
+  the shared object store. Existing worktrees are fast-forwarded to origin.
+  """
+  path = worktree_path(repo_name, session_id)
+  standalone_clone = os.path.exists(path) and not is_worktree(path)
+  store = _ensure_object_store(repo_name, clone_url, seed_path=path if standalone_clone else None)
+  upstream = f"origin/{default_branch(store)}"
+
+  if standalone_clone:
+    _retire_standalone_clone(path)
+
+  if not os.path.exists(path):
+    os.makedirs(session_dir(session_id), exist_ok=True)
+    store.git.worktree("prune")
+    store.git.worktree("add", "-B", session_branch(session_id), os.path.abspath(path), upstream)
+  else:
+    repo = git.Repo(path)
+    try:
+      repo.git.merge("--ff-only", upstream)
+    except git.GitCommandError:
+      print(f"Could not fast-forward {path} to {upstream}, keeping local state")
+  return path
+
+
+def remove_worktree(repo_name, session_id=DEFAULT_SESSION):
+  """
+  Remove the session's worktree and branch. The shared object store is kept.
+  """
+  path = worktree_path(repo_name, session_id)
+  store = git.Repo(f"{OBJECT_STORE_DIR}{repo_name}.git")
+  if is_worktree(path):
+    store.git.worktree("remove", "--force", os.path.abspath(path))
+  elif os.path.exists(path):
+    # standalone clone that was never linked to the store
+    shutil.rmtree(path)
+  store.git.worktree("prune")
+  if session_branch(session_id) in store.heads:
+    store.git.branch("-D", session_branch(session_id))
+  return True
+
+
+def recent_repos():
+  """
+  Names of the most recently loaded repos, most recent first.
+  """
+  if not os.path.exists(RECENT_REPOS_FILE):
+    return []
+  with open(RECENT_REPOS_FILE, "r") as f:
+    return json.load(f)
+
+
+def record_recent_repo(repo_name):
+  repos = [repo_name] + [r for r in recent_repos() if r != repo_name]
+  os.makedirs(os.path.dirname(RECENT_REPOS_FILE), exist_ok=True)
+  with open(RECENT_REPOS_FILE, "w") as f:
+    json.dump(repos[:MAX_RECENT_REPOS], f)
+
+
+def fork_and_clone_repo(repo_url, session_id=DEFAULT_SESSION):
+  repo_name = repo_name_from_url(repo_url)
   original_owner = repo_url.split("/")[-2]
 
   if original_owner != gh_username:
@@ -38,88 +176,66 @@ def fork_and_clone_repo(repo_url):
     original_repo = g.get_user(original_owner).get_repo(repo_name)
     # need to fork and clone
     forked_repo = g.get_user().create_fork(original_repo)
-    if not os.path.exists(repo_path):
-      git.Repo.clone_from(forked_repo.ssh_url, repo_path)
-    else:
-      repo = git.Repo(repo_path)
-      origin = repo.remotes.origin
-      origin.pull()
+    clone_url = forked_repo.ssh_url
   else:
     # can just clone for personal repo
-    if not os.path.exists(repo_path):
-      ssh_url = https_to_ssh(repo_url)
-      git.Repo.clone_from(ssh_url, repo_path)
-    else:
-      repo = git.Repo(repo_path)
-      origin = repo.remotes.origin
-      origin.pull()
+    clone_url = https_to_ssh(repo_url)
+
+  checkout_worktree(repo_name, clone_url, session_id)
   return True
 
 
-def clone_repo(repo_url):
+def clone_repo(repo_url, session_id=DEFAULT_SESSION):
   try:
-    if not os.path.exists(CACHE_DIR):
-      os.makedirs(CACHE_DIR)
-
-    repo_name = repo_url.split("/")[-1].replace(".git", "")
-    repo_path = os.path.join(CACHE_DIR, repo_name)
-
-    if not os.path.exists(repo_path):
-      git.Repo.clone_from(repo_url, repo_path)
-    else:
-      repo = git.Repo(repo_path)
-      origin = repo.remotes.origin
-      origin.pull()
+    checkout_worktree(repo_name_from_url(repo_url), repo_url, session_id)
     return True
   except:
     raise ("Failed to load repo")
 
 
-def commit_and_push_pr(repo_url, repo_name, commit_message, pr_title, pr_description):
+def commit_and_push_pr(repo_url, repo_name, commit_message, pr_title, pr_description,
+                       session_id=DEFAULT_SESSION):
   if (not repo_name) or (not commit_message) or (not pr_title) or (
       not pr_description):
     raise ("You need to include all: commit_message, pr_title, pr_description")
 
-  repo_path = f"{CACHE_DIR}{repo_name}"
-  repo = git.Repo(repo_path)
+  repo = git.Repo(worktree_path(repo_name, session_id))
+  base_branch = default_branch(git.Repo(f"{OBJECT_STORE_DIR}{repo_name}.git"))
 
-  # Set the Git username and email
-  repo.config_writer().set_value("user", "name", "shoggoth-coder").release()
-  repo.config_writer().set_value("user", "email",
-                                 "shoggoth-coder@gmail.com").release()
+  # Set the Git username and email (shared by all worktrees of the store)
+  repo.git.config("user.name", "shoggoth-coder")
+  repo.git.config("user.email", "shoggoth-coder@gmail.com")
 
+  if not repo.is_dirty(untracked_files=True):
+    raise ValueError("There are no changes to commit. Update a file in the repo first.")
   repo.git.add("--all")
-  repo.index.commit(commit_message)
+  repo.git.commit("-m", commit_message)
 
-  # push changes to remote origin/forked repo
   origin = repo.remote(name="origin")
-  origin.push()
-
   original_owner = repo_url.split("/")[-2]
   if original_owner != gh_username:
-    # if not personal repo, create PR
+    # push to a branch unique to this PR, so a recreated session never clashes
+    # with a branch left on the fork by an earlier PR
+    branch = f"{session_branch(session_id)}-{int(time.time())}"
+    origin.push(f"HEAD:refs/heads/{branch}").raise_if_error()
+
     g = Github(gh_access_token)
     original_repo = g.get_user(original_owner).get_repo(repo_name)
-    pull_request = original_repo.create_pull(title=pr_title, body=pr_description, base="main", head=f"{gh_username}:main")
+    pull_request = original_repo.create_pull(title=pr_title, body=pr_description, base=base_branch, head=f"{gh_username}:{branch}")
 
     # Get the pull request URL
     pull_request_url = pull_request.html_url
     return pull_request_url
   else:
+    # personal repo, push straight to the default branch
+    origin.push(f"HEAD:refs/heads/{base_branch}").raise_if_error()
     return repo_url
 
 
-def clear_repo_changes(repo_name):
-  repo_path = f"{CACHE_DIR}{repo_name}"
-  repo = git.Repo(repo_path)
-
-  # Clear all staged changes
-  repo.git.reset("HEAD")
-
-  # Clear all non-staged changes
-  repo.git.checkout("--", ".")
+def clear_repo_changes(repo_name, session_id=DEFAULT_SESSION):
+  repo = git.Repo(worktree_path(repo_name, session_id))
 
-  # Reset the repository to the HEAD commit
+  # Reset both staged and non-staged changes to the HEAD commit
   repo.git.reset("--hard", "HEAD")
 
   return True